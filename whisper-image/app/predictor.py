@@ -5,10 +5,15 @@ from __future__ import print_function
 
 import os
 import logging
-import json
+import subprocess
 import tempfile
+import threading
 import flask
 import boto3
+from botocore.config import Config
+import numpy as np
+import orjson
+import torch
 import whisper
 
 logging.basicConfig(level=logging.DEBUG)
@@ -16,8 +21,168 @@ logger = logging.getLogger(__name__)
 
 app = flask.Flask(__name__)
 
-s3_client = boto3.client("s3")
+s3_client = boto3.client("s3", config=Config(
+    retries={"mode": "standard", "max_attempts": 10},
+    tcp_keepalive=True
+))
 model_name = "medium.en"
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Loaded models are kept for the lifetime of the worker process so that the
+# weights are only read from disk and copied to the GPU once
+_MODEL_CACHE: dict[str, whisper.Whisper] = {}
+_MODEL_LOCK = threading.Lock()
+
+
+def _get_model(name):
+    """Return the Whisper model for `name`, loading it on first use.
+    """
+    model = _MODEL_CACHE.get(name)
+    if model is None:
+        with _MODEL_LOCK:
+            model = _MODEL_CACHE.get(name)
+            if model is None:
+                logger.info(f"Loading model {name} on {device}")
+                model = whisper.load_model(name, device=device)
+                _MODEL_CACHE[name] = model
+    return model
+
+
+# MP4-family containers may store their index (moov atom) at the end of the file,
+# so ffmpeg can only decode them from a seekable local file rather than a pipe
+SEEKABLE_INPUT_EXTENSIONS = {".m4a", ".m4b", ".mp4", ".mov"}
+# Formats that ffmpeg can always decode from a pipe. An empty decode of any other key
+# may be MP4-family content under an unrecognised extension, so it is retried from a file
+STREAMABLE_INPUT_EXTENSIONS = {".mp3", ".wav", ".flac", ".ogg", ".oga", ".opus", ".aac", ".webm", ".mka"}
+CHUNK_SIZE = 1 << 20
+
+# ffmpeg arguments either side of the input path for decoding to the 16kHz mono
+# float32 samples that Whisper expects. The resampler uses a shorter filter than
+# swresample's defaults (filter_size=32, phase_shift=10), which is cheaper and still
+# well above the precision that Whisper's log-mel features can make use of.
+_FFMPEG_INPUT_ARGS = ("ffmpeg", "-threads", "0", "-nostats", "-loglevel", "error", "-i")
+_FFMPEG_OUTPUT_ARGS = (
+    "-af", f"aresample={whisper.audio.SAMPLE_RATE}:resampler=swr:filter_size=16:phase_shift=6",
+    "-f", "f32le", "-ac", "1", "-acodec", "pcm_f32le", "-ar", str(whisper.audio.SAMPLE_RATE), "-"
+)
+
+
+class EmptyAudioError(RuntimeError):
+    """Raised when ffmpeg exits successfully without producing any samples.
+    """
+
+
+def _stream_body(body, fd, errors):
+    """Copy an S3 response body into the pipe `fd`, recording any failure in `errors`.
+    """
+    try:
+        with os.fdopen(fd, "wb") as pipe:
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                pipe.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg stopped reading; its exit status is reported by the caller
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        body.close()
+
+
+def _decode_audio(input_path, body=None):
+    """Decode audio with ffmpeg to the 16kHz mono samples expected by Whisper.
+
+    If `body` is given, it is streamed into ffmpeg's stdin from a background thread
+    so that decoding overlaps with the S3 transfer.
+    """
+    cmd = [*_FFMPEG_INPUT_ARGS, input_path, *_FFMPEG_OUTPUT_ARGS]
+    errors = []
+    feeder = None
+    # stderr goes to a file so that stdout can be read incrementally without ffmpeg
+    # blocking on a full stderr pipe
+    with tempfile.TemporaryFile() as stderr:
+        if body is None:
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+        else:
+            read_fd, write_fd = os.pipe()
+            try:
+                process = subprocess.Popen(cmd, stdin=read_fd, stdout=subprocess.PIPE, stderr=stderr)
+            except Exception:
+                os.close(write_fd)
+                body.close()
+                raise
+            finally:
+                os.close(read_fd)
+            feeder = threading.Thread(target=_stream_body, args=(body, write_fd, errors), daemon=True)
+            feeder.start()
+
+        samples = bytearray()
+        try:
+            with process.stdout:
+                for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):
+                    samples += chunk
+            process.wait()
+        finally:
+            # Don't leave ffmpeg running (and the feeder blocked on its stdin) if reading failed
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+            if feeder is not None:
+                feeder.join()
+        if errors:
+            raise errors[0]
+        if process.returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode("utf-8", "replace")
+            raise RuntimeError(f"Failed to decode audio: {message}")
+        if not samples:
+            raise EmptyAudioError("ffmpeg decoded no audio samples")
+
+    # ffmpeg already emits float32 samples, so the writable buffer is used as-is
+    # rather than converted from int16 in further full-length copies
+    return np.frombuffer(samples, np.float32)
+
+
+def _load_audio(bucket_name, object_key):
+    """Fetch an audio object from S3 and decode it, streaming where the format allows.
+
+    Raises EmptyAudioError if the object contains no audio samples at all, so that
+    the invocation fails rather than returning an empty transcript.
+    """
+    extension = os.path.splitext(object_key)[1].lower()
+    if extension not in SEEKABLE_INPUT_EXTENSIONS:
+        logger.info(f"Streaming s3://{bucket_name}/{object_key} to ffmpeg")
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+        try:
+            return _decode_audio("pipe:0", body=response["Body"])
+        except EmptyAudioError:
+            if extension in STREAMABLE_INPUT_EXTENSIONS:
+                raise
+            # MP4-family content under an unrecognised extension decodes to nothing
+            # from a pipe, so fall back to a seekable local copy
+            logger.warning(
+                f"No audio decoded from streamed s3://{bucket_name}/{object_key}, retrying from a local file"
+            )
+
+    with tempfile.NamedTemporaryFile(suffix=extension) as f:
+        logger.info(f"Downloading s3://{bucket_name}/{object_key} to {f.name}")
+        s3_client.download_file(bucket_name, object_key, f.name)
+        return _decode_audio(f.name)
+
+
+def _warmup(name):
+    """Load the model and, on a GPU, transcribe a short silent clip so that CUDA context
+    creation and kernel selection happen before the first request instead of during it.
+    """
+    model = _get_model(name)
+    if model.device.type != "cuda":
+        # There is no CUDA state to prime, and a CPU transcription would only delay startup
+        return
+    silence = torch.zeros(whisper.audio.SAMPLE_RATE * 15, device=model.device)
+    model.transcribe(silence, temperature=0.0)
+
+
+# Warm the default model at import so that /ping only succeeds once it is ready to serve
+_warmup(model_name)
 
 @app.route("/ping", methods=["GET"])
 def ping():
@@ -39,12 +204,11 @@ def transformation():
     content_type = flask.request.content_type
     request_data = flask.request.data
     logger.info(f"transformation: {content_type} {request_data}")
-    data = request_data.decode("utf-8")
 
     input_dict = None
 
     if flask.request.content_type == "application/json":
-        input_dict = json.loads(data)
+        input_dict = orjson.loads(request_data)
     else:
         return flask.Response(
             response="The predictor only supports application/json content type", status=415, mimetype="text/plain"
@@ -52,23 +216,18 @@ def transformation():
 
     bucket_name = input_dict["bucket_name"]
     object_key = input_dict["object_key"]
-    fd, filename = tempfile.mkstemp()
-    try:
-        os.close(fd)
-        logger.info(f"Downloading s3://{bucket_name}/{object_key} to {filename}")
-        s3_client.download_file(bucket_name, object_key, filename)
-
-        logger.info(f"Loading model {model_name}")
-        model = whisper.load_model(model_name)
-        logger.info(f"Transcribing {filename}")
-        result = model.transcribe(filename)
-        logger.info(f"Transcription of {filename} complete")
-    finally:
-        os.unlink(filename)
+    audio = _load_audio(bucket_name, object_key)
+
+    model = _get_model(model_name)
+    logger.info(f"Transcribing s3://{bucket_name}/{object_key}")
+    # Passing the samples as a tensor on the model's device makes Whisper compute the
+    # whole log-mel spectrogram there in one batched STFT instead of on the CPU
+    result = model.transcribe(torch.from_numpy(audio).to(model.device))
+    logger.info(f"Transcription of s3://{bucket_name}/{object_key} complete")
 
     payload = {
         **input_dict,
         "result": result
     }
-    response = json.dumps(payload)
+    response = orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
     return flask.Response(response=response, status=200, mimetype="application/json")